@@ -0,0 +1,23 @@
+import json
+import os
+import subprocess
+import yaml
+
+# Environment variable holding the already decrypted configuration as JSON
+config_env_var = 'CONFIG_JSON'
+
+# Function to load configuration variables from a sops-encrypted YAML file
+def load_config(config_path):
+    """Loads the configuration, decrypting with sops only if it is not already in the environment."""
+    config_json = os.environ.get(config_env_var)
+    if config_json:
+        return json.loads(config_json)
+    try:
+        result = subprocess.run(['sops', '-d', config_path], capture_output=True, text=True, check=True)
+        config_data = yaml.safe_load(result.stdout)
+    except subprocess.CalledProcessError as e:
+        print(f"Failed to decrypt configuration file: {e.stderr}")
+        exit(1)
+    # Pass the decrypted configuration on to child processes
+    os.environ[config_env_var] = json.dumps(config_data, default=str)
+    return config_data
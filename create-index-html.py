@@ -1,24 +1,27 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from s3transfer.manager import TransferManager
 import os
 import subprocess
-import yaml
+from config_loader import load_config
 from urllib.parse import quote
 from pathlib import Path
-import tempfile
 from PIL import Image
 import io
+import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-config_path = 'secrets/config.yaml'
+# pyvips is optional: when libvips is available it is used for image thumbnails, otherwise PIL
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
 
-# Function to load configuration variables from a sops-encrypted YAML file
-def load_config(config_path):
-    try:
-        result = subprocess.run(['sops', '-d', config_path], capture_output=True, text=True, check=True)
-        config_data = yaml.safe_load(result.stdout)
-        return config_data
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to decrypt configuration file: {e.stderr}")
-        exit(1)
+config_path = 'secrets/config.yaml'
+cache_path = '.s3-cache.json'
 
 # Load configuration
 config = load_config(config_path)
@@ -31,172 +34,257 @@ aws_secret_access_key = config['aws_secret_access_key']
 s3_endpoint_url = config['s3_endpoint_url']
 site_base = config['site_base']
 
+# Number of thumbnails generated concurrently; the S3 connection pool is sized to match
+max_workers = 16
+
+# Transfer settings for thumbnail uploads, shared by all workers. Its threads plus one download per
+# worker must fit in the S3 connection pool below.
+transfer_config = TransferConfig(multipart_threshold=5 * 1024 * 1024, max_concurrency=max_workers, use_threads=True)
+
+# Write buffer size for generated HTML pages
+html_write_buffer_size = 1 << 20
+
+# Per-thread state for thumbnail workers
+thread_local = threading.local()
+
+# Check for FFmpeg once instead of before every video
+try:
+    ffmpeg_installed = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+except FileNotFoundError:
+    ffmpeg_installed = False
+
 s3_client = boto3.client(
     's3', 
     aws_access_key_id=aws_access_key_id,
     aws_secret_access_key=aws_secret_access_key,
     endpoint_url=s3_endpoint_url,
     region_name=region_name,
+    config=Config(max_pool_connections=max_workers + transfer_config.max_request_concurrency),
 )
 
+# One transfer manager for all thumbnail uploads instead of a new one per upload_fileobj call
+transfer_manager = TransferManager(s3_client, transfer_config)
+
 def upload_file_to_s3(bucket_name, file_name, object_name, content_type, s3_client=s3_client):
-    """Uploads a file to the specified S3 bucket."""
+    """Uploads a file to the specified S3 bucket. Returns True on success."""
     try:
         s3_client.upload_file(file_name, bucket_name, object_name, ExtraArgs={'ContentType': content_type})
         print(f"Uploaded {file_name} to s3://bucket_name/{object_name}")
+        return True
     except Exception as e:
         print(f"Failed to upload to S3: {e}")
+        return False
 
-def list_subfolders(bucket_name, s3_client=s3_client):
+def list_objects(bucket_name, s3_client=s3_client):
+    """Lists every object in the bucket with a single flat listing, mapping keys to ETags."""
     paginator = s3_client.get_paginator('list_objects_v2')
+    objects = {}
+
+    for page in paginator.paginate(Bucket=bucket_name):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = obj['ETag']
+    return objects
+
+def load_cache(bucket_name, cache_path=cache_path):
+    """Loads the object ETags recorded for the bucket by the previous run."""
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            return json.load(f).get(bucket_name, {})
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(bucket_name, objects, cache_path=cache_path):
+    """Records the object ETags seen in this run for the next one."""
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[bucket_name] = objects
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+
+def list_subfolders(keys):
     subfolders = set()
 
-    for page in paginator.paginate(Bucket=bucket_name, Delimiter='/'):
-        if 'CommonPrefixes' in page:
-            for prefix in page['CommonPrefixes']:
-                subfolder = prefix['Prefix'].rstrip('/')
-                if subfolder != 'thumbnails':  # Exclude the 'thumbnails' folder
-                    subfolders.add(subfolder)
+    for key in keys:
+        if '/' in key:
+            subfolder = key.split('/', 1)[0]
+            if subfolder != 'thumbnails':  # Exclude the 'thumbnails' folder
+                subfolders.add(subfolder)
     return sorted(subfolders)
 
-def list_media_files(bucket_name, prefix='', s3_client=s3_client):
-    paginator = s3_client.get_paginator('list_objects_v2')
+def list_media_files(keys):
+    """Groups media keys by their top-level subfolder."""
     image_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff')
     video_extensions = ('.mp4', '.mov', '.avi', '.wmv', '.flv', '.mkv', '.webm')
     media_extensions = image_extensions + video_extensions
-    media_files = []
-
-    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-        if 'Contents' in page:
-            for obj in page['Contents']:
-                key = obj['Key']
-                # Exclude any files in the 'thumbnails' folder
-                if '/thumbnails/' in key or key.startswith('thumbnails/'):
-                    continue
-                if key.lower().endswith(media_extensions):
-                    media_files.append(key)
+    media_files = {}
+
+    for key in keys:
+        # Exclude any files in the 'thumbnails' folder
+        if '/thumbnails/' in key or key.startswith('thumbnails/'):
+            continue
+        if '/' in key and key.lower().endswith(media_extensions):
+            subfolder = key.split('/', 1)[0]
+            media_files.setdefault(subfolder, []).append(key)
     return media_files
 
-def generate_thumbnails(bucket_name, media_keys, prefix='', thumbnail_prefix='thumbnails/', s3_client=s3_client):
-    """Generates thumbnails for images and videos and uploads them to S3."""
+def redact_url_queries(text):
+    """Strips query strings from URLs so presigned credentials and signatures are not logged."""
+    return re.sub(r'(https?://[^\s?]+)\?\S*', r'\1', text)
+
+def upload_thumbnail(bucket_name, fileobj, thumbnail_key, transfer_manager=transfer_manager):
+    """Uploads a JPEG thumbnail through the transfer manager, using multipart for large ones."""
+    transfer_manager.upload(
+        fileobj,
+        bucket_name,
+        thumbnail_key,
+        extra_args={'ContentType': 'image/jpeg'}
+    ).result()
+
+def get_thumbnail_buffer():
+    """Returns an emptied bytes buffer reused across thumbnails on the current thread."""
+    buffer = getattr(thread_local, 'buffer', None)
+    if buffer is None:
+        buffer = thread_local.buffer = io.BytesIO()
+    buffer.seek(0)
+    buffer.truncate(0)
+    return buffer
+
+def generate_thumbnail(bucket_name, key, thumbnail_key, s3_client=s3_client):
+    """Generates a thumbnail for a single image or video and uploads it to S3. Returns True on success."""
     image_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff')
     video_extensions = ('.mp4', '.mov', '.avi', '.wmv', '.flv', '.mkv', '.webm')
+    extension = os.path.splitext(key)[1].lower()
+
+    if extension in image_extensions:
+        # Generate image thumbnail
+        try:
+            obj = s3_client.get_object(Bucket=bucket_name, Key=key)
+
+            # PIL reads the non-seekable S3 body fully into memory before decoding
+            source = obj['Body']
+
+            if pyvips is not None:
+                img_data = obj['Body'].read()
+                try:
+                    # libvips picks shrink-on-load and streams the resize in constant memory
+                    thumb = pyvips.Image.thumbnail_buffer(img_data, 150)
+                    thumb_data = thumb.jpegsave_buffer(Q=65, strip=True)
+                except pyvips.Error:
+                    # Formats libvips cannot load natively (e.g. BMP without magickload) fall back to PIL
+                    source = io.BytesIO(img_data)
+                else:
+                    upload_thumbnail(bucket_name, io.BytesIO(thumb_data), thumbnail_key)
+                    return True
+
+            with Image.open(source) as img:
+                #print(f"Generating thumbnail for {key}")
+                img.draft('RGB', (300, 300))  # Let libjpeg decode JPEGs at reduced scale; no-op for other formats
+                img.thumbnail((150, 150), Image.Resampling.LANCZOS)  # Adjust the thumbnail size as needed
+
+                # Save the thumbnail to this worker's reusable bytes buffer with compression
+                buffer = get_thumbnail_buffer()
+                img.save(buffer, format='JPEG', quality=65)  # Adjust 'quality' for compression
+
+                # Upload the compressed thumbnail to S3
+                buffer.seek(0)
+                upload_thumbnail(bucket_name, buffer, thumbnail_key)
+                # print(f"Generated and uploaded compressed thumbnail for {key} as {thumbnail_key}")
+                return True
+        except Exception as e:
+            print(f"Error generating thumbnail for {key}: {e}")
+
+    elif extension in video_extensions:
+        # Generate video thumbnail using FFmpeg
+        #print(f"Generating thumbnail for {key}")
+        try:
+            if not ffmpeg_installed:
+                print("FFmpeg is not installed or not found in PATH.")
+                return False
+
+            # Let FFmpeg read the video over HTTP with range requests so only the parts it needs are fetched
+            video_url = s3_client.generate_presigned_url('get_object', Params={'Bucket': bucket_name, 'Key': key}, ExpiresIn=3600)
+
+            # Generate thumbnail at 1 second into the video, scaled and compressed by FFmpeg.
+            # Videos shorter than that yield no frame, so retry from the start.
+            for seek_position in ('00:00:01.000', '0'):
+                ffmpeg_command = [
+                    'ffmpeg',
+                    '-loglevel', 'error',  # Show only error messages
+                    '-ss', seek_position,  # Seek on the input so FFmpeg jumps to the nearest keyframe
+                    '-i', video_url,
+                    '-vf', "scale='min(150,iw)':'min(150,ih)':force_original_aspect_ratio=decrease",  # Fit within 150x150
+                    '-frames:v', '1',
+                    '-q:v', '8',  # Adjust 'q:v' for FFmpeg quality (higher is more compressed)
+                    '-f', 'mjpeg',
+                    'pipe:1'
+                ]
+                try:
+                    result = subprocess.run(ffmpeg_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                except subprocess.CalledProcessError as e:
+                    print(f"FFmpeg failed for {key} (exit code {e.returncode}): {redact_url_queries(e.stderr.decode())}")
+                    return False
+                if result.stdout:
+                    break
+
+            if not result.stdout:
+                print(f"FFmpeg produced no frame for {key}")
+                return False
+
+            # Upload the compressed thumbnail to S3
+            upload_thumbnail(bucket_name, io.BytesIO(result.stdout), thumbnail_key)
+            #print(f"Generated and uploaded compressed thumbnail for {key} as {thumbnail_key}")
+            return True
+        except Exception as e:
+            print(f"Error generating thumbnail for {key}: {e}")
+    return False
+
+def generate_thumbnails(bucket_name, media_keys, prefix='', thumbnail_prefix='thumbnails/', existing_thumbnails=None, changed_keys=(), s3_client=s3_client):
+    """Generates thumbnails for images and videos and uploads them to S3.
+
+    Returns the thumbnail keys for all media keys and the set of media keys whose thumbnail failed.
+    """
     thumbnail_keys = []
+    failed_keys = set()
+
+    if existing_thumbnails is None:
+        # Build an index of existing thumbnails with a single listing instead of one HEAD per key
+        paginator = s3_client.get_paginator('list_objects_v2')
+        existing_thumbnails = set()
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=thumbnail_prefix):
+            for obj in page.get('Contents', []):
+                existing_thumbnails.add(obj['Key'])
 
     print("Starting thumbnail generation.")
 
-    for key in media_keys:
-        # Exclude files in the 'thumbnails' folder
-        if '/thumbnails/' in key or key.startswith('thumbnails/'):
-            continue
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for key in media_keys:
+            # Exclude files in the 'thumbnails' folder
+            if '/thumbnails/' in key or key.startswith('thumbnails/'):
+                continue
 
-        extension = os.path.splitext(key)[1].lower()
-        filename = os.path.basename(key)
-        base_filename = os.path.splitext(filename)[0]  # Remove extension from filename
-        # Define thumbnail key without double extensions
-        thumbnail_key = thumbnail_prefix + key[len(prefix):]
-        thumbnail_key = os.path.splitext(thumbnail_key)[0] + '.jpg'  # Ensure single .jpg extension
-        thumbnail_keys.append(thumbnail_key)
+            # Define thumbnail key without double extensions
+            thumbnail_key = thumbnail_prefix + key[len(prefix):]
+            thumbnail_key = os.path.splitext(thumbnail_key)[0] + '.jpg'  # Ensure single .jpg extension
+            thumbnail_keys.append(thumbnail_key)
 
-        # Check if thumbnail already exists
-        try:
-            s3_client.head_object(Bucket=bucket_name, Key=thumbnail_key)
-            # print(f"Thumbnail already exists for {key}, skipping generation.")
-            continue  # Skip thumbnail generation
-        except s3_client.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == '404':
-                # Thumbnail does not exist, proceed to generate
-                pass
-            else:
-                # Some other error occurred
-                print(f"Error checking for thumbnail {thumbnail_key}: {e}")
-                continue
+            # Check if thumbnail already exists and its source is unchanged
+            if thumbnail_key in existing_thumbnails and key not in changed_keys:
+                # print(f"Thumbnail already exists for {key}, skipping generation.")
+                continue  # Skip thumbnail generation
 
-        if extension in image_extensions:
-            # Generate image thumbnail
-            try:
-                # Download the image from S3
-                obj = s3_client.get_object(Bucket=bucket_name, Key=key)
-                img_data = obj['Body'].read()
+            futures[executor.submit(generate_thumbnail, bucket_name, key, thumbnail_key, s3_client=s3_client)] = key
 
-                # Open the image and create a thumbnail
-                with Image.open(io.BytesIO(img_data)) as img:
-                    #print(f"Generating thumbnail for {key}")
-                    img.thumbnail((150, 150))  # Adjust the thumbnail size as needed
-
-                    # Save the thumbnail to a bytes buffer with compression
-                    buffer = io.BytesIO()
-                    img.save(buffer, format='JPEG', quality=65)  # Adjust 'quality' for compression
-                    buffer.seek(0)
-
-                    # Upload the compressed thumbnail to S3
-                    s3_client.put_object(
-                        Bucket=bucket_name,
-                        Key=thumbnail_key,
-                        Body=buffer,
-                        ContentType='image/jpeg'
-                    )
-                    # print(f"Generated and uploaded compressed thumbnail for {key} as {thumbnail_key}")
-            except Exception as e:
-                print(f"Error generating thumbnail for {key}: {e}")
-
-        elif extension in video_extensions:
-            # Generate video thumbnail using FFmpeg
-            #print(f"Generating thumbnail for {key}")
-            try:
-                # Ensure FFmpeg is installed
-                ffmpeg_installed = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-                if ffmpeg_installed.returncode != 0:
-                    print("FFmpeg is not installed or not found in PATH.")
-                    continue
-
-                # Create a temporary file to store the video
-                with tempfile.NamedTemporaryFile(suffix=extension) as tmp_video:
-                    # Download the video from S3
-                    s3_client.download_fileobj(bucket_name, key, tmp_video)
-                    tmp_video.flush()
-
-                    # Create a temporary file for the thumbnail
-                    with tempfile.NamedTemporaryFile(suffix='.jpg') as tmp_thumbnail:
-                        # Generate thumbnail at 1 second into the video
-                        ffmpeg_command = [
-                            'ffmpeg',
-                            '-y',  # Automatically overwrite output files
-                            '-loglevel', 'error',  # Show only error messages
-                            '-ss', '00:00:01.000',
-                            '-i', tmp_video.name,
-                            '-vframes', '1',
-                            '-q:v', '4',  # Adjust 'q:v' for FFmpeg quality (higher is more compressed)
-                            tmp_thumbnail.name
-                        ]
-                        try:
-                            subprocess.run(ffmpeg_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                        except subprocess.CalledProcessError as e:
-                            print(f"FFmpeg failed for {key}: {e.stderr.decode()}")
-                            continue
-
-                        # Compress the thumbnail using PIL
-                        with Image.open(tmp_thumbnail.name) as img:
-                            # Save the image to a bytes buffer with compression
-                            img.thumbnail((150, 150))  # Adjust the thumbnail size as needed
-                            buffer = io.BytesIO()
-                            img.save(buffer, format='JPEG', quality=65)  # Adjust 'quality' for compression
-                            buffer.seek(0)
-
-                            # Upload the compressed thumbnail to S3
-                            s3_client.put_object(
-                                Bucket=bucket_name,
-                                Key=thumbnail_key,
-                                Body=buffer,
-                                ContentType='image/jpeg'
-                            )
-                        #print(f"Generated and uploaded compressed thumbnail for {key} as {thumbnail_key}")
-            except Exception as e:
-                print(f"Error generating thumbnail for {key}: {e}")
-    return thumbnail_keys
+        for future in as_completed(futures):
+            if not future.result():
+                failed_keys.add(futures[future])
+    return thumbnail_keys, failed_keys
 
 def generate_subfolder_html(subfolder, media_urls, thumbnail_urls, output_file):
-    html_content = f'''<!DOCTYPE html>
+    header = f'''<!DOCTYPE html>
 <html>
 <head>
     <title>{subfolder} - Media Gallery</title>
@@ -213,26 +301,24 @@ def generate_subfolder_html(subfolder, media_urls, thumbnail_urls, output_file):
 <a href="index.html">Back to Main Index</a>
 <hr>
 '''
-
-    for thumb_url, media_url in zip(thumbnail_urls, media_urls):
-        filename = os.path.basename(media_url)
-        html_content += f'''<div class="media">
-    <a href="{media_url}" target="_blank">
-        <img src="{thumb_url}" alt="{filename}">
-    </a>
-</div>\n'''
-
-    html_content += '''
+    footer = '''
 </body>
 </html>
 '''
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(html_content)
+    # Stream the page through a large write buffer instead of building it in memory
+    with open(output_file, 'w', buffering=html_write_buffer_size, encoding='utf-8') as f:
+        f.write(header)
+        f.writelines(f'''<div class="media">
+    <a href="{media_url}" target="_blank">
+        <img src="{thumb_url}" alt="{os.path.basename(media_url)}">
+    </a>
+</div>\n''' for thumb_url, media_url in zip(thumbnail_urls, media_urls))
+        f.write(footer)
     print(f"Subfolder HTML file '{output_file}' has been generated.")
 
 def generate_index_html(subfolders, output_file='index.html'):
-    html_content = '''<!DOCTYPE html>
+    header = '''<!DOCTYPE html>
 <html>
 <head>
     <title>Media Gallery - Subfolders</title>
@@ -247,18 +333,19 @@ def generate_index_html(subfolders, output_file='index.html'):
 <h1>Media Gallery</h1>
 <ul>
 '''
-    for subfolder in subfolders:
-        subfolder_encoded = quote(subfolder)
-        html_content += f'    <li class="folder"><a href="{subfolder_encoded}.html">{subfolder}</a></li>\n'
-
-    html_content += '''
+    footer = '''
 </ul>
 </body>
 </html>
 '''
-
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(html_content)
+    subfolders_encoded = [quote(subfolder, safe='') for subfolder in subfolders]
+
+    # Stream the page through a large write buffer instead of building it in memory
+    with open(output_file, 'w', buffering=html_write_buffer_size, encoding='utf-8') as f:
+        f.write(header)
+        for subfolder, subfolder_encoded in zip(subfolders, subfolders_encoded):
+            f.write(f'    <li class="folder"><a href="{subfolder_encoded}.html">{subfolder}</a></li>\n')
+        f.write(footer)
     print(f"Main index HTML file '{output_file}' has been generated.")
 
 def get_public_urls(bucket_name, keys):
@@ -266,8 +353,19 @@ def get_public_urls(bucket_name, keys):
     return urls
 
 def main():
-    # Step 1: List subfolders in the S3 bucket's root
-    subfolders = list_subfolders(bucket_name)
+    # Step 1: List the whole bucket once and derive subfolders, media files and existing thumbnails from it
+    objects = list_objects(bucket_name)
+    subfolders = list_subfolders(objects)
+    media_files = list_media_files(objects)
+    existing_thumbnails = {key for key in objects if key.startswith('thumbnails/')}
+
+    # Compare against the previous run to find modified sources and unchanged subfolders
+    cached_objects = load_cache(bucket_name)
+    cached_media_files = list_media_files(cached_objects)
+    changed_keys = {key for key, etag in objects.items() if key in cached_objects and cached_objects[key] != etag}
+
+    # Only work that succeeded is recorded, so failures are retried on the next run
+    objects_to_cache = dict(objects)
 
     # Step 2: Generate the main index.html listing subfolders
     generate_index_html(subfolders)
@@ -278,19 +376,37 @@ def main():
     # Step 4: For each subfolder, list media files and generate an HTML page
     for subfolder in subfolders:
         prefix = subfolder + '/'
-        media_keys = list_media_files(bucket_name, prefix=prefix)
+        media_keys = media_files.get(subfolder, [])
         media_urls = get_public_urls(bucket_name, media_keys)
 
         # Step 5: Generate thumbnails for images and videos
-        thumbnail_keys = generate_thumbnails(bucket_name, media_keys, prefix=prefix)
+        thumbnail_keys, failed_keys = generate_thumbnails(bucket_name, media_keys, prefix=prefix, existing_thumbnails=existing_thumbnails, changed_keys=changed_keys)
         thumbnail_urls = get_public_urls(bucket_name, thumbnail_keys)
+        for key in failed_keys:
+            # Keep the previous ETag (or none) so the thumbnail is treated as outdated again
+            if key in cached_objects:
+                objects_to_cache[key] = cached_objects[key]
+            else:
+                del objects_to_cache[key]
 
-        # Step 6: Generate HTML file for the subfolder
+        # Skip the page if it was uploaded by a previous run and its media list is unchanged
         subfolder_html_file = f'{subfolder}.html'
+        if (subfolder_html_file in objects and subfolder_html_file in cached_objects
+                and media_keys == cached_media_files.get(subfolder, [])):
+            continue
+
+        # Step 6: Generate HTML file for the subfolder
         generate_subfolder_html(subfolder, media_urls, thumbnail_urls, subfolder_html_file)
 
         # Step 7: Upload the subfolder HTML file to S3
-        upload_file_to_s3(bucket_name, subfolder_html_file, subfolder_html_file, 'text/html')
+        if upload_file_to_s3(bucket_name, subfolder_html_file, subfolder_html_file, 'text/html'):
+            objects_to_cache[subfolder_html_file] = objects.get(subfolder_html_file, '')
+        else:
+            objects_to_cache.pop(subfolder_html_file, None)
+
+    # Step 8: Remember this listing for the next run
+    save_cache(bucket_name, objects_to_cache)
+    transfer_manager.shutdown()
 
 if __name__ == '__main__':
     main()
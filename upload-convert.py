@@ -1,37 +1,39 @@
 import os
+import shutil
 import asyncio
+import atexit
 import tempfile
 from telethon import TelegramClient
 from PIL import Image
 import boto3
+from botocore.config import Config
 import subprocess
 import sqlite3
-import yaml
+from config_loader import load_config
 from datetime import datetime, timezone
 import argparse
 
 # Path to the encrypted configuration file
 config_path = 'secrets/config.yaml'  # Ensure this file is encrypted with sops
 
+def positive_int(value):
+    """argparse type accepting integers of at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 # Parse command-line arguments
 parser = argparse.ArgumentParser(description='Process Telegram channel media.')
 parser.add_argument('--channel-username', required=True, help='Telegram channel username or invite link')
 parser.add_argument('--start-date', required=True, help='Start date in YYYY-MM-DD format')
 parser.add_argument('--end-date', required=True, help='End date in YYYY-MM-DD format')
 parser.add_argument('--s3-key-prefix', required=True, help='S3 key prefix for uploaded files')
+parser.add_argument('--workers', type=positive_int, default=4, help='Number of messages processed concurrently')
+parser.add_argument('--max-ffmpeg-processes', type=positive_int, default=2, help='Maximum number of concurrent ffmpeg processes')
 
 args = parser.parse_args()
 
-# Function to load configuration variables from a sops-encrypted YAML file
-def load_config(config_path):
-    try:
-        result = subprocess.run(['sops', '-d', config_path], capture_output=True, text=True, check=True)
-        config_data = yaml.safe_load(result.stdout)
-        return config_data
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to decrypt configuration file: {e.stderr}")
-        exit(1)
-
 # Load configuration
 config = load_config(config_path)
 
@@ -40,6 +42,8 @@ s3_key_prefix = args.s3_key_prefix
 channel_username = args.channel_username
 start_date_str = args.start_date
 end_date_str = args.end_date
+workers = args.workers
+max_ffmpeg_processes = args.max_ffmpeg_processes
 
 # Configuration Variables
 api_id = config['api_id']
@@ -55,82 +59,154 @@ database_path = f"{s3_key_prefix}-processed_messages.db"
 start_date = datetime.strptime(start_date_str, '%Y-%m-%d').replace(tzinfo=timezone.utc)
 end_date = datetime.strptime(end_date_str, '%Y-%m-%d').replace(tzinfo=timezone.utc)
 
+# JPEG sources smaller than this are uploaded as-is instead of being re-encoded
+jpeg_copy_max_size = 2 * 1024 * 1024
+
+# H.264 encoder settings in order of preference: hardware encoders first, then libx264
+video_encoders = [
+    ['-c:v', 'h264_nvenc', '-preset', 'p4', '-cq', '28'],
+    ['-c:v', 'h264_videotoolbox', '-q:v', '60'],
+    ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '28'],
+]
+
+def select_video_encoder():
+    """Returns the first encoder that can actually encode a test frame on this machine."""
+    for encoder_args in video_encoders[:-1]:
+        command = [
+            'ffmpeg', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', 'color=size=256x256',
+            '-frames:v', '1',
+            *encoder_args,
+            '-f', 'null', '-'
+        ]
+        try:
+            if subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+                return encoder_args
+        except FileNotFoundError:
+            break
+    return video_encoders[-1]
+
+# Probe the encoders once at startup
+video_encoder_args = select_video_encoder()
+
 # Initialize Telegram Client
 client = TelegramClient('session_name', api_id, api_hash)
 
+# Initialize S3 client once so connections are reused across uploads
+s3_client = boto3.client(
+    's3', 
+    aws_access_key_id=aws_access_key_id,
+    aws_secret_access_key=aws_secret_access_key,
+    endpoint_url=s3_endpoint_url,
+    region_name=region_name,
+    config=Config(max_pool_connections=16, retries={'max_attempts': 3, 'mode': 'adaptive'}),
+)
+
 def process_image(input_path, output_path):
-    """Compresses an image to lower quality."""
+    """Compresses an image to lower quality. Returns True on success."""
     try:
-        image = Image.open(input_path)
-        image.save(output_path, 'JPEG')
+        # Telegram photos are usually already compressed JPEGs; copy small ones instead of re-encoding
+        with open(input_path, 'rb') as f:
+            header = f.read(3)
+        if header == b'\xff\xd8\xff' and os.path.getsize(input_path) < jpeg_copy_max_size:
+            shutil.copyfile(input_path, output_path)
+            print(f"Image copied to {output_path}")
+            return True
+        with Image.open(input_path) as image:
+            image.save(output_path, 'JPEG', optimize=True, progressive=True)
         print(f"Image saved to {output_path}")
+        return True
     except Exception as e:
         print(f"Failed to process image: {e}")
+        return False
 
-def process_video(input_path, output_path):
-    """Compresses a video using ffmpeg."""
+async def process_video(input_path, output_path):
+    """Compresses a video using ffmpeg. Returns True on success."""
     try:
         # Use ffmpeg to compress video
         command = [
             'ffmpeg', '-y', '-i', input_path,
-            '-c:v', 'libx264',
-            '-b:v', '500k',
-            '-bufsize', '500k',
-            '-vf', 'scale=iw:ih',     # Ensures original resolution
-            '-c:a', 'copy',
+            *video_encoder_args,
+            '-c:a', 'aac',
+            '-b:a', '96k',
+            '-movflags', '+faststart',
             '-loglevel', 'error',
             output_path
         ]
-        subprocess.run(command, check=True)
+        # Run ffmpeg as an asyncio subprocess so it does not block the event loop
+        process = await asyncio.create_subprocess_exec(*command, stderr=asyncio.subprocess.PIPE)
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            print(f"ffmpeg error: {stderr.decode()}")
+            return False
         print(f"Video saved to {output_path}")
-    except subprocess.CalledProcessError as e:
-        print(f"ffmpeg error: {e.stderr}")
+        return True
     except Exception as e:
         print(f"Failed to process video: {e}")
+        return False
 
 def upload_to_s3(file_path, s3_key):
-    """Uploads a file to the specified S3 bucket."""
-    s3_client = boto3.client(
-        's3', 
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
-        endpoint_url=s3_endpoint_url,
-        region_name=region_name,
-    )
+    """Uploads a file to the specified S3 bucket. Returns True on success."""
     try:
         s3_client.upload_file(file_path, bucket_name, s3_key)
         print(f"Uploaded {file_path} to s3://{bucket_name}/{s3_key}")
+        return True
     except Exception as e:
         print(f"Failed to upload to S3: {e}")
+        return False
+
+# Persistent database connection and the set of already processed message IDs
+db_conn = None
+processed_ids = set()
+# Message IDs waiting to be written; flushed in batches to avoid a commit per message
+pending_ids = []
+db_batch_size = 100
 
 def init_db():
     """Initializes the SQLite database to keep track of processed messages."""
-    conn = sqlite3.connect(database_path)
-    cursor = conn.cursor()
-    cursor.execute('''
+    global db_conn, processed_ids
+    db_conn = sqlite3.connect(database_path)
+    db_conn.execute('PRAGMA journal_mode=WAL')
+    db_conn.execute('PRAGMA synchronous=NORMAL')
+    db_conn.execute('''
         CREATE TABLE IF NOT EXISTS processed_messages (
             message_id INTEGER PRIMARY KEY
         )
     ''')
-    conn.commit()
-    conn.close()
+    db_conn.commit()
+    atexit.register(close_db)
+    # Load processed IDs up front so lookups never hit the database
+    processed_ids = set(row[0] for row in db_conn.execute('SELECT message_id FROM processed_messages'))
 
 def is_message_processed(message_id):
     """Checks if a message has already been processed."""
-    conn = sqlite3.connect(database_path)
-    cursor = conn.cursor()
-    cursor.execute('SELECT 1 FROM processed_messages WHERE message_id = ?', (message_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
+    return message_id in processed_ids
 
 def mark_message_processed(message_id):
     """Marks a message as processed."""
-    conn = sqlite3.connect(database_path)
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO processed_messages (message_id) VALUES (?)', (message_id,))
-    conn.commit()
-    conn.close()
+    processed_ids.add(message_id)
+    pending_ids.append(message_id)
+    if len(pending_ids) >= db_batch_size:
+        flush_processed_messages()
+
+def flush_processed_messages():
+    """Writes pending processed message IDs to the database in a single transaction."""
+    if not pending_ids:
+        return
+    db_conn.executemany('INSERT OR IGNORE INTO processed_messages (message_id) VALUES (?)', [(message_id,) for message_id in pending_ids])
+    db_conn.commit()
+    pending_ids.clear()
+
+def close_db():
+    """Flushes pending IDs, merges the WAL into the database file and closes the connection."""
+    global db_conn
+    if db_conn is None:
+        return
+    flush_processed_messages()
+    # Only the main database file is cached between workflow runs, so leave nothing in the WAL
+    db_conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    db_conn.close()
+    db_conn = None
 
 async def main():
     await client.start()
@@ -143,48 +219,86 @@ async def main():
         print(f"Error retrieving channel: {e}")
         return
 
-    # Iterate over messages from oldest to newest
-    async for message in client.iter_messages(channel, reverse=True):
-        # Filter messages by date
-        if message.date <= start_date:
-            continue
-        if message.date >= end_date:
-            continue
-        if is_message_processed(message.id):
-            print(f"Message {message.id} already processed. Skipping.")
-            continue
-        if message.photo or message.video:
-            # Download media
-            print(f"Processing message {message.id}")
-            media = message.photo or message.video
-            with tempfile.TemporaryDirectory() as temp_dir:
-                input_file = await client.download_media(media, file=temp_dir)
-                if not input_file:
-                    print(f"Failed to download media for message {message.id}")
-                    continue
-                if message.photo:
-                    # Process image
-                    output_file = os.path.join(temp_dir, f'compressed_{message.id}.jpg')
-                    process_image(input_file, output_file)
-                elif message.video:
-                    # Process video
-                    output_file = os.path.join(temp_dir, f'compressed_{message.id}.mp4')
-                    process_video(input_file, output_file)
-                elif message.document:
-                    # Process document
-                    output_file = os.path.join(temp_dir, f'compressed_{message.id}.{message.document.mime_type.split("/")[1]}')
-                    process_image(input_file, output_file)
-                else:
-                    print(f"Unsupported media type in message {message.id}")
-                    continue
-                # Upload to S3
-                upload_to_s3(output_file, f"{s3_key_prefix}/{os.path.basename(output_file)}")
-                # Mark message as processed
-                mark_message_processed(message.id)
-        else:
-            print(f"No media in message {message.id}. Skipping.")
-            # Mark message as processed to avoid checking again
+    try:
+        await process_messages(channel)
+    finally:
+        flush_processed_messages()
+
+async def process_message(message, ffmpeg_semaphore):
+    """Downloads, compresses and uploads the media of a single message."""
+    loop = asyncio.get_running_loop()
+    if message.photo or message.video:
+        # Download media
+        print(f"Processing message {message.id}")
+        media = message.photo or message.video
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_file = await client.download_media(media, file=temp_dir)
+            if not input_file:
+                print(f"Failed to download media for message {message.id}")
+                return
+            # Blocking compression and S3 uploads run in worker threads so the Telegram client keeps running
+            if message.photo:
+                # Process image
+                output_file = os.path.join(temp_dir, f'compressed_{message.id}.jpg')
+                processed = await loop.run_in_executor(None, process_image, input_file, output_file)
+            elif message.video:
+                # Process video, limiting how many ffmpeg processes run at once
+                output_file = os.path.join(temp_dir, f'compressed_{message.id}.mp4')
+                async with ffmpeg_semaphore:
+                    processed = await process_video(input_file, output_file)
+            elif message.document:
+                # Process document
+                output_file = os.path.join(temp_dir, f'compressed_{message.id}.{message.document.mime_type.split("/")[1]}')
+                processed = await loop.run_in_executor(None, process_image, input_file, output_file)
+            else:
+                print(f"Unsupported media type in message {message.id}")
+                return
+            # Leave failed messages unmarked so the next run retries them
+            if not processed:
+                return
+            # Upload to S3
+            if not await loop.run_in_executor(None, upload_to_s3, output_file, f"{s3_key_prefix}/{os.path.basename(output_file)}"):
+                return
+            # Mark message as processed
             mark_message_processed(message.id)
+    else:
+        print(f"No media in message {message.id}. Skipping.")
+        # Mark message as processed to avoid checking again
+        mark_message_processed(message.id)
+
+async def process_messages(channel):
+    """Feeds messages through a bounded queue to concurrent workers so downloads, compression and uploads overlap."""
+    queue = asyncio.Queue(maxsize=workers * 2)
+    ffmpeg_semaphore = asyncio.Semaphore(max_ffmpeg_processes)
+
+    async def worker():
+        while True:
+            message = await queue.get()
+            try:
+                await process_message(message, ffmpeg_semaphore)
+            except Exception as e:
+                print(f"Failed to process message {message.id}: {e}")
+            finally:
+                queue.task_done()
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    try:
+        # Iterate over messages from oldest to newest
+        async for message in client.iter_messages(channel, reverse=True):
+            # Filter messages by date
+            if message.date <= start_date:
+                continue
+            if message.date >= end_date:
+                continue
+            if is_message_processed(message.id):
+                print(f"Message {message.id} already processed. Skipping.")
+                continue
+            await queue.put(message)
+        await queue.join()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 if __name__ == '__main__':
     with client: